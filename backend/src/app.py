@@ -1,32 +1,86 @@
-import json
+import asyncio
+import concurrent.futures
+import functools
+import itertools
 import logging
+import operator
 import os
 import re
-from ctypes.wintypes import RECT
+import zipfile
 from datetime import datetime
+from enum import Enum
+from io import BytesIO
 
-import requests
+import httpx
+import orjson
+from brotli_asgi import BrotliMiddleware
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, File, Form, Response
+from fastapi import FastAPI, HTTPException, File, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from ogc.na import ingest_json
-from ogc.na.provenance import ProvenanceMetadata, FileProvenanceMetadata
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+# ogc.na (and, through it, rdflib, pyld, jsonschema...) is imported lazily
+# inside the uplift endpoints so that workers that only serve health checks
+# or /remote-fetch do not pay its import time and memory footprint
 
 logging.config.fileConfig(Path(__file__).parent / 'logging.conf', disable_existing_loggers=False)
 logger = logging.getLogger('ogc_playground')
 
 CORS_ALLOW_ORIGINS = os.environ.get('CORS_ALLOW_ORIGINS', '*').split(',')
 
-rfa = os.environ.get('REMOTE_FETCH_ALLOWED', '').strip()
-if rfa:
-    REMOTE_FETCH_ALLOWED = re.compile(rfa)
-    logger.info('Remote fetch allowed for "%s"', rfa)
+# One or more (whitespace-separated) regular expressions with the allowed
+# remote fetch endpoints. The patterns are combined into a single alternation
+# regex at startup so that matching a URL is a single C-level operation
+# instead of a per-pattern Python loop.
+rfa_list = os.environ.get('REMOTE_FETCH_ALLOWED', '').split()
+if rfa_list:
+    REMOTE_FETCH_ALLOWED_PATTERNS = tuple(sorted(rfa_list))
+    REMOTE_FETCH_ALLOWED = re.compile('|'.join(f'(?:{p})' for p in rfa_list))
+    logger.info('Remote fetch allowed for "%s"', REMOTE_FETCH_ALLOWED.pattern)
 else:
+    REMOTE_FETCH_ALLOWED_PATTERNS = ()
     REMOTE_FETCH_ALLOWED = None
     logger.info('Remote fetch disabled')
 
+# The remote fetch configuration is immutable after startup, so the
+# /remote-fetch introspection response is encoded once here
+_REMOTE_FETCH_INFO = {'enabled': REMOTE_FETCH_ALLOWED is not None}
+if REMOTE_FETCH_ALLOWED:
+    _REMOTE_FETCH_INFO['regex'] = REMOTE_FETCH_ALLOWED.pattern
+    _REMOTE_FETCH_INFO['patterns'] = list(REMOTE_FETCH_ALLOWED_PATTERNS)
+_REMOTE_FETCH_INFO_BYTES = orjson.dumps(_REMOTE_FETCH_INFO)
+
+# Graphs above this size are serialized as N-Triples instead of Turtle, since
+# rdflib's Turtle serializer scales badly with graph size (qname resolution)
+TTL_MAX_TRIPLES = int(os.environ.get('TTL_MAX_TRIPLES', '10000'))
+
+# Chunk size for streaming ZIP archives to the client
+ZIP_CHUNK_SIZE = 64 * 1024
+
+# Maximum accepted request body size, in bytes; oversize requests are
+# rejected up front instead of being buffered and parsed
+MAX_REQUEST_SIZE = int(os.environ.get('MAX_REQUEST_SIZE', str(50 * 1024 * 1024)))
+
+# A '%' in a Turtle PN_LOCAL needs escaping unless it starts a %XX hex escape
+_TTL_LOCAL_PERCENT_RE = re.compile('%(?![0-9A-Fa-f]{2})')
+
 app = FastAPI(root_path=os.environ.get('BACKEND_ROOT_PATH', ''))
 
+
+async def enforce_max_request_size(request: Request, call_next):
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_SIZE:
+        return Response(orjson.dumps({'detail': {
+            'type': 'RequestEntityTooLarge',
+            'msg': f'Request body exceeds the maximum allowed size of {MAX_REQUEST_SIZE} bytes',
+        }}), status_code=413, media_type='application/json')
+    return await call_next(request)
+
+# Registered before (and therefore inside) CORSMiddleware, so that early
+# 413 responses still carry the CORS headers cross-origin browsers need
+app.add_middleware(BaseHTTPMiddleware, dispatch=enforce_max_request_size)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ALLOW_ORIGINS,
@@ -36,20 +90,266 @@ app.add_middleware(
 )
 logger.info('Allowed CORS origins: %s', CORS_ALLOW_ORIGINS)
 
+# Turtle and JSON-LD outputs are large and highly repetitive, so they
+# compress very well on the wire; falls back to gzip for older clients
+app.add_middleware(BrotliMiddleware, quality=4, minimum_size=1024)
+
+# Shared async HTTP client so that remote fetches do not block the event
+# loop and connections (and TLS sessions) are reused across requests
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    follow_redirects=True,
+    headers={'Accept': 'application/json, application/ld+json;q=0.9, */*;q=0.8'},
+)
+
+
+@app.on_event('shutdown')
+async def close_http_client():
+    await http_client.aclose()
+
+
+def _preimport():
+    # Pre-import the heavy dependencies so that uplift workers are ready
+    # before the first request reaches them
+    from ogc.na import ingest_json  # noqa: F401
+
+
+# Process pool for the CPU-bound uplift step, so that concurrent requests
+# are not serialized behind this worker's GIL
+uplift_executor: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+@app.on_event('startup')
+def create_uplift_executor():
+    global uplift_executor
+    uplift_executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=int(os.environ.get('UPLIFT_WORKERS', os.cpu_count() or 1)),
+        initializer=_preimport,
+    )
+
+
+@app.on_event('shutdown')
+def shutdown_uplift_executor():
+    if uplift_executor:
+        uplift_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_generate_graph(jsondoc, context, base):
+    from ogc.na import ingest_json
+    return ingest_json.generate_graph(jsondoc, context, base)
+
+
+class JsonUpliftOutputType(str, Enum):
+    TTL = 'ttl'
+    NTRIPLES = 'nt'
+    JELLY = 'jelly'
+    EXPANDED = 'expanded'
+    ALL = 'all'
+
+
+@functools.lru_cache(maxsize=128)
+def _validate_context_cached(context):
+    """
+    Memoized wrapper around `ingest_json.validate_context`. Frontends tend
+    to submit the same context over and over, and parsing + validating the
+    YAML on every request is pure CPU waste; repeated contexts are returned
+    from the cache keyed by their raw content.
+
+    :param context: raw YAML context definition (str or bytes)
+    :return: the validated context
+    """
+    from ogc.na import ingest_json
+    return ingest_json.validate_context(context=context)
+
+
+def _bind_context_prefixes(g, context) -> None:
+    """
+    Pre-binds on a graph the prefixes declared in an uplift context
+    definition. rdflib's Turtle serializer otherwise discovers qnames
+    lazily while serializing, which is the hot path for large graphs.
+
+    :param g: the rdflib Graph to bind the prefixes on
+    :param context: the validated uplift context definition
+    """
+    ctx = context.get('context') if isinstance(context, dict) else None
+    if not isinstance(ctx, dict):
+        return
+    # JSON-LD context definitions can be scoped by JSON path
+    scopes = ctx.values() if all(k.startswith(('$', '.')) for k in ctx) else (ctx,)
+    for scope in scopes:
+        if not isinstance(scope, dict):
+            continue
+        for term, value in scope.items():
+            if term.startswith('@'):
+                continue
+            if isinstance(value, str) and value.endswith(('/', '#')):
+                g.namespace_manager.bind(term, value, override=True, replace=True)
+            elif isinstance(value, dict) and value.get('@prefix') and isinstance(value.get('@id'), str):
+                g.namespace_manager.bind(term, value['@id'], override=True, replace=True)
+
+
+def _serialize_ttl_fast(g) -> str:
+    """
+    Serializes a graph as Turtle writing directly from its (pre-bound)
+    namespace bindings, bypassing rdflib's Turtle serializer and its lazy
+    per-term qname discovery. Each distinct term is rendered at most once.
+
+    :param g: the rdflib Graph to serialize
+    :return: the Turtle serialization as a string
+    """
+    from rdflib import Literal, URIRef
+
+    nm = g.namespace_manager
+    n3_cache = {}
+    used_prefixes = set()
+
+    def uri_n3(uri):
+        # NamespaceManager.normalizeUri (what URIRef.n3 uses) skips the
+        # PN_LOCAL checks of rdflib's own Turtle serializer, so mirror
+        # them here: escape parentheses and bare '%', and fall back to
+        # <uri> form when the local part would still be invalid
+        try:
+            pfx, _, local = nm.compute_qname(uri, generate=False)
+        except Exception:
+            return uri.n3()
+        local = local.replace('(', r'\(').replace(')', r'\)')
+        local = _TTL_LOCAL_PERCENT_RE.sub('\\%', local)
+        if local.endswith('.'):
+            return uri.n3()
+        used_prefixes.add(pfx)
+        return f'{pfx}:{local}'
+
+    def n3(term):
+        r = n3_cache.get(term)
+        if r is None:
+            if isinstance(term, URIRef):
+                r = uri_n3(term)
+            elif isinstance(term, Literal):
+                # Route datatype URIs through uri_n3 so their prefixes are
+                # validated and recorded too
+                r = term._literal_n3(qname_callback=uri_n3)
+            else:
+                r = term.n3(nm)
+            n3_cache[term] = r
+        return r
+
+    body = []
+    for subject, triples in itertools.groupby(sorted(g), key=operator.itemgetter(0)):
+        preds = ' ;\n  '.join(f'{n3(p)} {n3(o)}' for _, p, o in triples)
+        body.append(f'{n3(subject)} {preds} .\n')
+
+    # Only declare the prefixes the triples actually use, like rdflib's
+    # own serializer does
+    ns_by_prefix = dict(nm.namespaces())
+    out = [f'@prefix {pfx}: <{ns_by_prefix[pfx]}> .\n' for pfx in sorted(used_prefixes)]
+    if out:
+        out.append('\n')
+    return ''.join(out + body)
+
+
+def _generate_ttl(g, as_nt: bool | None = None) -> Response:
+    """
+    Serializes a graph as Turtle or, for graphs larger than `TTL_MAX_TRIPLES`,
+    as streamed N-Triples (whose serialization is O(n), unlike Turtle's).
+
+    :param g: the rdflib Graph to serialize
+    :param as_nt: force (or forbid) N-Triples output instead of applying
+      the size threshold
+    :return: a (possibly streaming) Response with the serialized graph
+    """
+    if as_nt is None:
+        as_nt = len(g) > TTL_MAX_TRIPLES
+    if as_nt:
+        return _generate_nt(g)
+    return Response(_serialize_ttl_fast(g), media_type='text/turtle')
+
+
+def _generate_nt(g) -> StreamingResponse:
+    """
+    Serializes a graph as N-Triples, streaming one triple per line.
+
+    :param g: the rdflib Graph to serialize
+    :return: a StreamingResponse with the serialized graph
+    """
+    from rdflib import Literal
+    from rdflib.plugins.serializers.nt import _quoteLiteral
+
+    def triples():
+        # Literal.n3() produces Turtle quoting (e.g. long strings for
+        # newlines), which is invalid N-Triples; literals must go through
+        # the N-Triples quoting rules instead
+        for s, p, o in g.triples((None, None, None)):
+            o_nt = _quoteLiteral(o) if isinstance(o, Literal) else o.n3()
+            yield f'{s.n3()} {p.n3()} {o_nt} .\n'
+    return StreamingResponse(triples(), media_type='application/n-triples')
+
+
+def _generate_jelly(g) -> Response:
+    """
+    Serializes a graph using the Jelly binary RDF format, which is much
+    faster to produce and consume than text-based serializations.
+
+    :param g: the rdflib Graph to serialize
+    :return: a Response with the serialized graph
+    """
+    buf = BytesIO()
+    g.serialize(destination=buf, format='jelly')
+    return Response(buf.getvalue(), media_type='application/x-jelly-rdf')
+
+
+async def _generate_all(g, expanded, uplifted) -> StreamingResponse:
+    """
+    Builds a ZIP archive with all the available output formats for an uplift:
+    Turtle, Jelly, expanded JSON-LD and uplifted JSON. The serializations are
+    independent CPU-bound steps, so they run concurrently in worker threads
+    and only the (cheap) archive assembly is done serially.
+
+    :param g: the rdflib Graph resulting from the uplift
+    :param expanded: the expanded JSON-LD document
+    :param uplifted: the uplifted JSON document
+    :return: a StreamingResponse with the ZIP archive
+    """
+    jelly_buf = BytesIO()
+    ttl, _, exp, upl = await asyncio.gather(
+        asyncio.to_thread(_serialize_ttl_fast, g),
+        asyncio.to_thread(g.serialize, destination=jelly_buf, format='jelly'),
+        # No indentation: the archive is meant for machine consumption, and
+        # pretty-printing doubles the bytes to format and deflate
+        asyncio.to_thread(orjson.dumps, expanded),
+        asyncio.to_thread(orjson.dumps, uplifted),
+    )
+    buf = BytesIO()
+    # compresslevel=1: deflate CPU time is the bottleneck here, and higher
+    # levels barely reduce the size of already-repetitive RDF/JSON text
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zfile:
+        zfile.writestr('ttl.ttl', ttl)
+        zfile.writestr('data.jelly', jelly_buf.getvalue())
+        zfile.writestr('expanded.jsonld', exp)
+        zfile.writestr('uplifted.json', upl)
+    buf.seek(0)
+
+    def chunks():
+        while data := buf.read(ZIP_CHUNK_SIZE):
+            yield data
+    return StreamingResponse(chunks(), media_type='application/zip',
+                             headers={'Content-Disposition': 'attachment; filename="uplift.zip"'})
+
 
 async def _remote_fetch(url: str) -> bytes | bool:
     if not REMOTE_FETCH_ALLOWED or not REMOTE_FETCH_ALLOWED.fullmatch(url):
         logger.warning('Remote fetch not allowed for %s', url)
         return False
     logger.info('Remote fetching %s', url)
-    r = requests.get(url)
+    r = await http_client.get(url)
     r.raise_for_status()
     return r.content
 
 
 @app.get('/remote-fetch',
          response_description='an object with a boolean `enabled` property and, optionally, a `regex`' \
-                              'property to match against potential enpoints',
+                              'property to match against potential enpoints and a `patterns` property' \
+                              ' with the individual allowed patterns',
          )
 async def remote_fetch():
     """
@@ -57,22 +357,23 @@ async def remote_fetch():
     external JSON files) is enabled and, if so, what endpoints are allowed (using
     a regular expression).
     :return: an object with a boolean `enabled` property and, optionally, a `regex`
-      property to match against potential enpoints
+      property to match against potential enpoints and a `patterns` property with
+      the list of individual allowed patterns that `regex` combines
     """
-    r = {'enabled': REMOTE_FETCH_ALLOWED is not None}
-    if REMOTE_FETCH_ALLOWED:
-        r['regex'] = REMOTE_FETCH_ALLOWED.pattern
-    return r
+    return Response(_REMOTE_FETCH_INFO_BYTES, media_type='application/json')
 
 
 @app.post("/json-uplift", response_description='The output textual document depending on the selected output format')
-async def json_uplift(context: bytes = File('', description='YAML contents for the uplift context definition'),
+async def json_uplift(context: bytes = File('', max_length=MAX_REQUEST_SIZE,
+                                            description='YAML contents for the uplift context definition'),
                       contexturl: str | None = Form(None, description='URL for the YAML context definition'),
-                      jsondoc: bytes = File('', alias='json', description='JSON textual source document'),
+                      jsondoc: bytes = File('', alias='json', max_length=MAX_REQUEST_SIZE,
+                                            description='JSON textual source document'),
                       jsonurl: str | None = Form(None, description='URL for the JSON source document'),
                       output: str | None = Form(None, description=(
-                              'Type of output: `ttl` for Turtle or `expanded` for expanded JSON-LD. Otherwise,'
-                              ' the transformed JSON file will be returned.')),
+                              'Type of output: `ttl` for Turtle, `nt` for N-Triples, `jelly` for binary'
+                              ' Jelly RDF, `expanded` for expanded JSON-LD or `all` for a ZIP archive'
+                              ' with every format. Otherwise, the transformed JSON file will be returned.')),
                       base: str | None = Form(None, description='Base URI for relative URIs'),
                       provenance: bool = Form(True, description='Add provenance metadata')):
     """
@@ -85,18 +386,22 @@ async def json_uplift(context: bytes = File('', description='YAML contents for t
     :param contexturl: URL for the YAML context definition
     :param jsondoc: JSON textual source document
     :param jsonurl: URL for the JSON source document
-    :param output: Type of output: `ttl` for Turtle or `expanded` for expanded JSON-LD. Otherwise,
+    :param output: Type of output: `ttl` for Turtle, `nt` for N-Triples, `jelly` for binary Jelly RDF,
+      `expanded` for expanded JSON-LD or `all` for a ZIP archive with every format. Otherwise,
       the transformed JSON file will be returned.
     :param base: Base URI for relative URIs
     :return: The output textual document depending on the selected output format
     """
     try:
-        start = datetime.now()
+        from ogc.na import ingest_json
+        from ogc.na.provenance import ProvenanceMetadata, FileProvenanceMetadata
+
+        start = datetime.now() if provenance else None
         if isinstance(context, bytes):
             context = context.decode('utf-8')
         if not context and contexturl:
             context = await _remote_fetch(contexturl)
-        context = ingest_json.validate_context(context=context)
+        context = _validate_context_cached(context)
 
         if not jsondoc:
             if jsonurl:
@@ -117,31 +422,52 @@ async def json_uplift(context: bytes = File('', description='YAML contents for t
                         "msg": "No JSON source specified",
                     }
                 )
-        jsondoc = json.loads(jsondoc)
-        g, expanded, uplifted = ingest_json.generate_graph(jsondoc, context, base)
+        jsondoc = orjson.loads(jsondoc)
+        g, expanded, uplifted = await asyncio.get_running_loop().run_in_executor(
+            uplift_executor, _run_generate_graph, jsondoc, context, base)
+        _bind_context_prefixes(g, context)
 
+        # Only pay for the metadata objects if provenance was requested
         prov_metadata = ProvenanceMetadata(
             context=FileProvenanceMetadata(uri=contexturl),
             doc=FileProvenanceMetadata(uri=jsonurl),
             start=start,
             end=datetime.now(),
-        )
+        ) if provenance else None
 
-        if output == 'ttl':
+        if output == JsonUpliftOutputType.TTL:
+            as_nt = len(g) > TTL_MAX_TRIPLES
             if provenance:
-                prov_metadata.output = FileProvenanceMetadata(uri='#', mime_type='text/turtle')
+                prov_metadata.output = FileProvenanceMetadata(
+                    uri='#', mime_type='application/n-triples' if as_nt else 'text/turtle')
                 ingest_json.generate_provenance(g, prov_metadata)
-            return Response(g.serialize(format='ttl'), media_type='text/turtle')
-        elif output == 'expanded':
+            return _generate_ttl(g, as_nt)
+        elif output == JsonUpliftOutputType.NTRIPLES:
+            if provenance:
+                prov_metadata.output = FileProvenanceMetadata(uri='#', mime_type='application/n-triples')
+                ingest_json.generate_provenance(g, prov_metadata)
+            return _generate_nt(g)
+        elif output == JsonUpliftOutputType.JELLY:
+            if provenance:
+                prov_metadata.output = FileProvenanceMetadata(uri='#', mime_type='application/x-jelly-rdf')
+                ingest_json.generate_provenance(g, prov_metadata)
+            return _generate_jelly(g)
+        elif output == JsonUpliftOutputType.EXPANDED:
             if provenance:
                 prov_metadata.output = FileProvenanceMetadata(uri='#', mime_type='application/ld+json')
                 ingest_json.add_jsonld_provenance(expanded, prov_metadata)
             return expanded
+        elif output == JsonUpliftOutputType.ALL:
+            if provenance:
+                prov_metadata.output = FileProvenanceMetadata(uri='#', mime_type='application/zip')
+                ingest_json.generate_provenance(g, prov_metadata)
+                ingest_json.add_jsonld_provenance(expanded, prov_metadata)
+            return await _generate_all(g, expanded, uplifted)
         else:
             return uplifted
     except HTTPException:
         raise
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         raise HTTPException(
             status_code=400,
             detail={
@@ -162,8 +488,7 @@ async def json_uplift(context: bytes = File('', description='YAML contents for t
             }
         )
     except Exception as e:
-        import traceback
-        traceback.print_exception(e)
+        logger.exception('json-uplift failed')
         raise HTTPException(
             status_code=400,
             detail={"type": type(e).__qualname__, "msg": e.msg if hasattr(e, 'msg') else str(e)}